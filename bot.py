@@ -1,8 +1,18 @@
 import gspread
 import asyncio
 import logging
+import logging.handlers
 import traceback
 import html
+import json
+import queue
+import atexit
+import copy
+import functools
+import contextvars
+import time
+import threading
+from bisect import bisect_right
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -25,12 +35,179 @@ from datetime import datetime, timedelta
 from time import sleep
 
 # Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
+LOG_LEVELS = {
+    "": logging.INFO,
+    __name__: logging.DEBUG,
+    "httpx": logging.WARNING,
+    "telegram": logging.INFO,
+    "gspread": logging.INFO,
+}
+DEBUG_SAMPLE_LIMIT = 20      # debug-записей на логгер за окно
+DEBUG_SAMPLE_WINDOW = 10     # секунд
+
+log_chat_id = contextvars.ContextVar("log_chat_id", default=None)
+log_handler_name = contextvars.ContextVar("log_handler_name", default=None)
+
+class ContextFilter(logging.Filter):
+    """Добавляет в запись chat id и имя обработчика текущего update"""
+
+    def filter(self, record):
+        if not hasattr(record, "chat_id"):
+            record.chat_id = log_chat_id.get()
+        if not hasattr(record, "handler"):
+            record.handler = log_handler_name.get()
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """Ограничивает число debug-записей каждого логгера за окно времени"""
+
+    def __init__(self, limit=DEBUG_SAMPLE_LIMIT, window=DEBUG_SAMPLE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows = {}  # имя логгера -> [начало окна, принято, отброшено]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        now = time.monotonic()
+        dropped = 0
+        with self._lock:
+            state = self._windows.get(record.name)
+            if state is None or now - state[0] >= self.window:
+                dropped = state[2] if state else 0
+                self._windows[record.name] = [now, 1, 0]
+                accepted = True
+            elif state[1] < self.limit:
+                state[1] += 1
+                accepted = True
+            else:
+                state[2] += 1
+                accepted = False
+        if dropped:
+            self._report(record.name, dropped)
+        return accepted
+
+    def flush(self, force=False):
+        """Сводка по отброшенным записям для завершившихся окон"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                (name, state[2]) for name, state in self._windows.items()
+                if force or now - state[0] >= self.window
+            ]
+            for name, _ in expired:
+                del self._windows[name]
+        for name, dropped in expired:
+            if dropped:
+                self._report(name, dropped)
+
+    def _report(self, name, dropped):
+        # Сводка идет через логгер модуля в обход его уровня, чтобы не потеряться
+        record = logger.makeRecord(
+            logger.name, logging.INFO, __file__, 0,
+            "Отброшено debug-записей %s: %d", (name, dropped), None,
+            extra={"sampled_logger": name, "sampled_out": dropped}
+        )
+        logger.handle(record)
+
+    def _run(self):
+        while not self._stopped.wait(self.window):
+            self.flush()
+
+    def start(self):
+        threading.Thread(target=self._run, name="log-sampling", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush(force=True)
+
+class JsonFormatter(logging.Formatter):
+    """Структурированный вывод записей в JSON"""
+
+    FIELDS = ("chat_id", "handler", "duration_ms", "sampled_logger", "sampled_out")
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, сохраняющий поля записи для JsonFormatter"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    """Логирование через очередь: запись в stderr выполняется фоновым потоком"""
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    sampling_filter = DebugSamplingFilter()
+    queue_handler.addFilter(sampling_filter)
+    queue_handler.addFilter(ContextFilter())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    sampling_filter.start()
+    # atexit вызывает функции в обратном порядке: сводка уходит до остановки listener
+    atexit.register(listener.stop)
+    atexit.register(sampling_filter.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+def log_handler(func):
+    """Логирует chat id, имя и длительность обработчика update"""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: CallbackContext):
+        # Вложенные вызовы обработчиков логируются в рамках внешнего
+        if log_handler_name.get() is not None:
+            return await func(update, context)
+
+        chat = update.effective_chat if isinstance(update, Update) else None
+        chat_token = log_chat_id.set(chat.id if chat else None)
+        name_token = log_handler_name.set(func.__name__)
+        start = time.perf_counter()
+        try:
+            return await func(update, context)
+        finally:
+            logger.info(
+                "Обработчик завершен",
+                extra={"duration_ms": round((time.perf_counter() - start) * 1000, 2)}
+            )
+            log_handler_name.reset(name_token)
+            log_chat_id.reset(chat_token)
+    return wrapper
+
 # Конфигурация
 SPREADSHEET_ID = "1oPXXHOzbAYlPZlgKOo8XFKkhaZl20KOP-zXDYL5r1w4"
 SCOPE = [
@@ -58,27 +235,123 @@ params_cache = {}
 last_updated = None
 CACHE_TIMEOUT = 300  # 5 минут
 
+# История параметров
+HISTORY_WORKSHEET = "История параметров"
+HISTORY_HEADER = ["Версия", "Время", "Курс ¥", "Курс $", "Соотношение ¥/$", "Доставка"]
+PARAM_KEYS = ["cny_rate", "usd_rate", "jpy_to_usd_ratio", "delivery_rate"]
+
 # Инициализация Google Sheets
 try:
     creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", SCOPE)
     client = gspread.authorize(creds)
-    sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Лист1")
+    spreadsheet = client.open_by_key(SPREADSHEET_ID)
+    sheet = spreadsheet.worksheet("Лист1")
+    try:
+        history_sheet = spreadsheet.worksheet(HISTORY_WORKSHEET)
+    except gspread.exceptions.WorksheetNotFound:
+        history_sheet = spreadsheet.add_worksheet(title=HISTORY_WORKSHEET, rows=1000, cols=len(HISTORY_HEADER))
+        history_sheet.append_row(HISTORY_HEADER)
     logger.info("Успешное подключение к Google Sheets")
 except Exception as e:
     logger.error(f"Ошибка подключения: {e}")
     raise
 
+def parse_value(cell_value):
+    """Преобразование значения ячейки в число"""
+    if isinstance(cell_value, (int, float)):
+        return float(cell_value)
+    if cell_value and isinstance(cell_value, str):
+        return float(cell_value.replace(',', '.'))
+    return 0.0
+
+class ParameterHistory:
+    """Append-only история параметров с поиском версии на момент времени"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._timestamps = []
+        self._snapshots = []
+        self._by_version = {}
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def _add(self, version, params, timestamp):
+        snapshot = {key: params[key] for key in PARAM_KEYS}
+        snapshot["version"] = version
+        snapshot["timestamp"] = timestamp
+        self._timestamps.append(timestamp)
+        self._snapshots.append(snapshot)
+        self._by_version[version] = snapshot
+        return snapshot
+
+    def last_version(self):
+        """Номер последней сохраненной версии (0, если истории нет)"""
+        return self._snapshots[-1]["version"] if self._snapshots else 0
+
+    def load(self):
+        """Загрузка истории из листа (один раз при запуске)"""
+        rows = self.worksheet.get_values("A2:F", value_render_option="UNFORMATTED_VALUE")
+        for row_num, row in enumerate(rows, start=2):
+            try:
+                version = int(row[0])
+                timestamp = datetime.fromisoformat(str(row[1]))
+                params = dict(zip(PARAM_KEYS, map(parse_value, row[2:6])))
+                if len(params) < len(PARAM_KEYS):
+                    raise ValueError("не хватает столбцов")
+            except (ValueError, TypeError, IndexError) as e:
+                logger.warning("Пропуск строки %d листа '%s': %s", row_num, HISTORY_WORKSHEET, e)
+                continue
+
+            if version <= self.last_version():
+                logger.warning("Пропуск строки %d листа '%s': версия %d не больше %d",
+                               row_num, HISTORY_WORKSHEET, version, self.last_version())
+                continue
+            if self._timestamps and timestamp < self._timestamps[-1]:
+                logger.warning("Версия %d раньше предыдущей, время выровнено", version)
+                timestamp = self._timestamps[-1]
+            self._add(version, params, timestamp)
+        logger.info("Загружено версий параметров: %d", len(self))
+
+    def append(self, params, timestamp=None):
+        """Добавление новой версии; существующие версии не изменяются"""
+        timestamp = timestamp or datetime.now()
+        if self._timestamps and timestamp < self._timestamps[-1]:
+            timestamp = self._timestamps[-1]
+        version = self.last_version() + 1
+        # Сначала запись в таблицу: версия в памяти всегда есть и в листе
+        self.worksheet.append_row(
+            [version, timestamp.isoformat()] + [params[key] for key in PARAM_KEYS]
+        )
+        return self._add(version, params, timestamp).copy()
+
+    def latest(self):
+        """Последняя версия параметров или None"""
+        return self._snapshots[-1].copy() if self._snapshots else None
+
+    def get(self, version):
+        """Версия параметров по номеру"""
+        return self._by_version[version].copy()
+
+    def at(self, timestamp):
+        """Версия параметров, действовавшая на момент timestamp (O(log n))"""
+        idx = bisect_right(self._timestamps, timestamp)
+        return self._snapshots[idx - 1].copy() if idx else None
+
+    def changed(self, params):
+        """Отличаются ли параметры от последней версии"""
+        latest = self.latest()
+        return latest is None or any(latest[key] != params[key] for key in PARAM_KEYS)
+
+parameter_history = ParameterHistory(history_sheet)
+parameter_history.load()
+
 def refresh_parameters(force=False):
     """Обновление кеша параметров"""
     global params_cache, last_updated
     try:
         if force or (last_updated is None) or (datetime.now() - last_updated > timedelta(seconds=CACHE_TIMEOUT)):
             values = sheet.batch_get(["B2", "B3", "B4", "B5"])
-            
-            def parse_value(cell_value):
-                if cell_value and isinstance(cell_value, str):
-                    return float(cell_value.replace(',', '.'))
-                return 0.0
 
             new_params = {
                 "cny_rate": parse_value(values[0][0][0]) if values[0] and values[0][0] else 0.0,
@@ -88,6 +361,11 @@ def refresh_parameters(force=False):
                 "last_modified": datetime.now().isoformat()
             }
             
+            # Сначала история: кеш обновляется, только если версия сохранена
+            if parameter_history.changed(new_params):
+                snapshot = parameter_history.append(new_params)
+                logger.info("Новая версия параметров: %d", snapshot['version'])
+
             if new_params != params_cache:
                 logger.info("Обновление кеша параметров")
                 params_cache = new_params
@@ -104,6 +382,18 @@ def get_parameters():
     refresh_parameters(force=True)
     return params_cache.copy()
 
+def get_parameter_snapshot(version=None):
+    """Снимок параметров из истории: по номеру версии или последний"""
+    if version is not None:
+        return parameter_history.get(version)
+    snapshot = parameter_history.latest()
+    if snapshot is None:
+        refresh_parameters(force=True)
+        snapshot = parameter_history.latest()
+    if snapshot is None:
+        raise LookupError("История параметров пуста")
+    return snapshot
+
 def save_parameters(new_params):
     """Сохранение параметров в таблицу"""
     global params_cache
@@ -121,7 +411,9 @@ def save_parameters(new_params):
                         {'range': 'B5', 'values': [[new_params['delivery_rate']]]}
                     ])
                     logger.debug("Параметры сохранены")
-                    refresh_parameters(force=True)
+                    if not refresh_parameters(force=True):
+                        logger.error("Параметры записаны, но новая версия не сохранена")
+                        return False
                     return True
                 except gspread.exceptions.APIError as e:
                     logger.error(f"Ошибка API (попытка {attempt + 1}): {e}")
@@ -158,6 +450,7 @@ def parameters_keyboard():
         resize_keyboard=True
     )
 
+@log_handler
 async def start(update: Update, context: CallbackContext):
     await update.message.reply_text(
         "🏍 Добро пожаловать в China Moto!",
@@ -165,6 +458,7 @@ async def start(update: Update, context: CallbackContext):
     )
     return ConversationHandler.END
 
+@log_handler
 async def cancel(update: Update, context: CallbackContext):
     context.user_data.clear()
     await update.message.reply_text(
@@ -173,6 +467,7 @@ async def cancel(update: Update, context: CallbackContext):
     )
     return ConversationHandler.END
 
+@log_handler
 async def add_item_start(update: Update, context: CallbackContext):
     context.user_data.clear()
     await update.message.reply_text(
@@ -181,6 +476,7 @@ async def add_item_start(update: Update, context: CallbackContext):
     )
     return NAME
 
+@log_handler
 async def save_name(update: Update, context: CallbackContext):
     if update.message.text == "Отмена ❌":
         return await cancel(update, context)
@@ -192,6 +488,7 @@ async def save_name(update: Update, context: CallbackContext):
     )
     return TRACK
 
+@log_handler
 async def save_track(update: Update, context: CallbackContext):
     if update.message.text == "Отмена ❌":
         return await cancel(update, context)
@@ -203,12 +500,15 @@ async def save_track(update: Update, context: CallbackContext):
     )
     return PRICE_CNY
 
+@log_handler
 async def save_price_cny(update: Update, context: CallbackContext):
     if update.message.text == "Отмена ❌":
         return await cancel(update, context)
     
     try:
-        params = get_parameters()
+        refresh_parameters()
+        params = get_parameter_snapshot()
+        context.user_data['params_version'] = params['version']
         context.user_data['price_cny'] = float(update.message.text.replace(',', '.'))
         context.user_data['price_byn'] = context.user_data['price_cny'] * params['cny_rate']
         await update.message.reply_text(
@@ -216,10 +516,19 @@ async def save_price_cny(update: Update, context: CallbackContext):
             reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена ❌")]], resize_keyboard=True)
     )
         return WEIGHT
+    except LookupError as e:
+        logger.error(f"Ошибка параметров: {e}")
+        await update.message.reply_text(
+            "❌ Параметры недоступны, попробуйте позже",
+            reply_markup=main_keyboard()
+        )
+        context.user_data.clear()
+        return ConversationHandler.END
     except ValueError:
         await update.message.reply_text("❌ Введите число")
         return PRICE_CNY
 
+@log_handler
 async def save_weight(update: Update, context: CallbackContext):
     if update.message.text == "Отмена ❌":
         return await cancel(update, context)
@@ -235,12 +544,13 @@ async def save_weight(update: Update, context: CallbackContext):
         await update.message.reply_text("❌ Введите число")
         return WEIGHT
 
+@log_handler
 async def save_shipping(update: Update, context: CallbackContext):
     if update.message.text == "Отмена ❌":
         return await cancel(update, context)
     
     try:
-        params = get_parameters()
+        params = get_parameter_snapshot(context.user_data['params_version'])
         context.user_data['shipping_per_kg'] = float(update.message.text.replace(',', '.'))
         shipping_cost = (context.user_data['shipping_per_kg'] + params['delivery_rate']) * context.user_data['weight']
         context.user_data['shipping'] = shipping_cost  # Общая стоимость доставки в $
@@ -255,12 +565,13 @@ async def save_shipping(update: Update, context: CallbackContext):
         await update.message.reply_text("❌ Ошибка расчета. Введите число")
         return PRICE_SHIPPING
 
+@log_handler
 async def save_package(update: Update, context: CallbackContext):
     if update.message.text == "Отмена ❌":
         return await cancel(update, context)
     
     try:
-        params = get_parameters()
+        params = get_parameter_snapshot(context.user_data['params_version'])
         context.user_data['package'] = float(update.message.text.replace(',', '.'))
         
         # Расчет стоимостей
@@ -294,6 +605,7 @@ async def save_package(update: Update, context: CallbackContext):
         await update.message.reply_text("❌ Ошибка расчета")
         return await cancel(update, context)
 
+@log_handler
 async def save_status(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
@@ -315,7 +627,8 @@ async def save_status(update: Update, context: CallbackContext):
         context.user_data['total_rub'],                # Общая стоимость (₽)
         context.user_data['total_usd'],                # Общая стоимость ($)
         context.user_data['package'],                  # Упаковка
-        status                                         # Статус
+        status,                                        # Статус
+        context.user_data['params_version']            # Версия параметров
     ]
     
     try:
@@ -335,6 +648,7 @@ async def save_status(update: Update, context: CallbackContext):
 
 VIEW_ITEM = 11
 
+@log_handler
 async def show_items(update: Update, context: CallbackContext):
     try:
         sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Лист1")
@@ -398,6 +712,7 @@ async def show_items(update: Update, context: CallbackContext):
         return ConversationHandler.END
 
 
+@log_handler
 async def view_item_details(update: Update, context: CallbackContext):
     if update.message.text == "Главное меню":
         return await main_menu(update, context)
@@ -431,6 +746,8 @@ async def view_item_details(update: Update, context: CallbackContext):
                                     f"💵 Общая стоимость: {float(full_row[8].replace(',', '.')):.2f} $\n" \
                                     f"🎁 Упаковка: {float(full_row[9].replace(',', '.')):.2f} $\n" \
                                     f"📌 Статус: {full_row[10] if len(full_row) > 10 else 'нет данных'}"
+                if len(full_row) > 11 and full_row[11]:
+                    response_text += f"\n⚙️ Версия параметров: {full_row[11]}"
                 
                 await update.message.reply_text(
                     response_text,
@@ -464,6 +781,7 @@ async def view_item_details(update: Update, context: CallbackContext):
     
     return ConversationHandler.END
 
+@log_handler
 async def main_menu(update: Update, context: CallbackContext):
     context.user_data.clear()
     
@@ -483,22 +801,24 @@ async def main_menu(update: Update, context: CallbackContext):
         
     return ConversationHandler.END
 
+@log_handler
 async def show_parameters(update: Update, context: CallbackContext):
     """Показать текущие параметры"""
     try:
-        params = get_parameters()
+        params = get_parameter_snapshot()
         text = (
             "📌 Текущие параметры:\n\n"
             f"• Курс ¥: {params['cny_rate']} RUB\n"
             f"• Курс $: {params['usd_rate']} RUB\n"
             f"• Соотношение ¥/$: {params['jpy_to_usd_ratio']}\n"
             f"• Доставка в Минск: {params['delivery_rate']} $\n"
-            f"🕒 Последнее обновление: {last_updated.strftime('%H:%M:%S') if last_updated else 'N/A'}"
+            f"⚙️ Версия {params['version']} от {params['timestamp'].strftime('%d.%m.%Y %H:%M:%S')}"
         )
         await update.message.reply_text(text, reply_markup=parameters_keyboard())
     except Exception as e:
         await update.message.reply_text("❌ Ошибка загрузки параметров", reply_markup=main_keyboard())
 
+@log_handler
 async def parameters_menu(update: Update, context: CallbackContext):
     """Меню управления параметрами"""
     await update.message.reply_text(
@@ -506,6 +826,7 @@ async def parameters_menu(update: Update, context: CallbackContext):
         reply_markup=parameters_keyboard()
     )
 
+@log_handler
 async def settings_menu(update: Update, context: CallbackContext):
     """Меню изменения параметров"""
     try:
@@ -522,6 +843,7 @@ async def settings_menu(update: Update, context: CallbackContext):
     except Exception as e:
         await update.message.reply_text("❌ Ошибка загрузки меню", reply_markup=main_keyboard())
 
+@log_handler
 async def settings_button_handler(update: Update, context: CallbackContext):
     """Обработчик кнопок меню параметров"""
     query = update.callback_query
@@ -554,6 +876,7 @@ async def settings_button_handler(update: Update, context: CallbackContext):
         await query.message.reply_text("❌ Ошибка", reply_markup=main_keyboard())
     return ConversationHandler.END
 
+@log_handler
 async def handle_parameter_input(update: Update, context: CallbackContext):
     """Обработка ввода новых значений параметров"""
     text = update.message.text
@@ -584,6 +907,7 @@ async def handle_parameter_input(update: Update, context: CallbackContext):
     context.user_data.clear()
     return ConversationHandler.END
 
+@log_handler
 async def handle_message(update: Update, context: CallbackContext):
     """Обработчик текстовых сообщений"""
     if context.user_data.get('state'):
@@ -605,6 +929,7 @@ async def handle_message(update: Update, context: CallbackContext):
     except Exception as e:
         logger.error(f"Ошибка: {e}")
 
+@log_handler
 async def error_handler(update: Update, context: CallbackContext):
     logger.error("Ошибка:", exc_info=context.error)
     tb = "".join(traceback.format_exception(type(context.error), context.error, context.error.__traceback__))
@@ -619,6 +944,32 @@ async def error_handler(update: Update, context: CallbackContext):
             reply_markup=main_keyboard()
         )
 
+@log_handler
+async def set_log_level(update: Update, context: CallbackContext):
+    """Просмотр и изменение уровней логирования: /loglevel [логгер] [уровень]"""
+    if update.effective_user is None or update.effective_user.id != ADMIN_ID:
+        return
+
+    args = context.args or []
+    if len(args) == 2:
+        name = "" if args[0] == "root" else args[0]
+        level = logging.getLevelName(args[1].upper())
+        if not isinstance(level, int):
+            await update.message.reply_text(f"❌ Неизвестный уровень: {args[1]}")
+            return
+        logging.getLogger(name).setLevel(level)
+        LOG_LEVELS[name] = level
+        logger.info("Уровень логгера %s изменен на %s", args[0], logging.getLevelName(level))
+    elif args:
+        await update.message.reply_text("Использование: /loglevel [логгер] [DEBUG|INFO|WARNING|ERROR]")
+        return
+
+    text = "📝 Уровни логирования:\n\n" + "\n".join(
+        f"• {name or 'root'}: {logging.getLevelName(logging.getLogger(name).level)}"
+        for name in sorted(LOG_LEVELS)
+    )
+    await update.message.reply_text(text)
+
 def main():
     application = Application.builder().token("7524666016:AAFTwXVNntSzV-wIRn7NZ9d8DgELsPbdgKA").build()
 
@@ -684,6 +1035,7 @@ def main():
     )
 
     application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('loglevel', set_log_level))
     application.add_handler(add_item_handler)
     application.add_handler(view_items_handler)  # Добавляем новый обработчик
     application.add_handler(settings_handler)